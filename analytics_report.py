@@ -0,0 +1,115 @@
+# analytics_report.py — офлайн-отчёт по событиям MarketSafe (analytics/*.jsonl[.gz])
+# Файлы читаются построчно, целиком в память не загружаются.
+# Пример: python analytics_report.py analytics --top 20
+import argparse
+import gzip
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+# Порядок шагов ClaimForm (см. bot.py): "start" — нажатие «Автогенератор претензии»,
+# "claim_done" — претензия сформирована
+CLAIM_FUNNEL = ["start", "fio", "contact", "seller", "order_id", "date", "product", "defect", "demand", "amount",
+                "claim_done"]
+QUERY_EVENTS = ("ai_query", "legal_query", "example_query")
+
+
+def iter_files(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            for name in sorted(os.listdir(p)):
+                if name.endswith(".jsonl") or name.endswith(".jsonl.gz"):
+                    yield os.path.join(p, name)
+        elif os.path.exists(p):
+            yield p
+
+
+def iter_events(paths):
+    for path in iter_files(paths):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # недописанная строка после аварийной остановки — пропускаем
+                    continue
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def normalize_query(q: str) -> str:
+    return re.sub(r"\s+", " ", q.strip().lower())
+
+
+def build_report(paths, top: int = 10):
+    kinds = Counter()
+    queries = Counter()
+    latencies = defaultdict(list)
+    failures = Counter()
+    funnel = {step: set() for step in CLAIM_FUNNEL}
+
+    for ev in iter_events(paths):
+        kind = ev.get("ev", "")
+        kinds[kind] += 1
+        if kind in QUERY_EVENTS:
+            if ev.get("q"):
+                queries[normalize_query(ev["q"])] += 1
+            if "ms" in ev:
+                latencies[kind].append(ev["ms"])
+            if ev.get("ok") is False:
+                failures[kind] += 1
+        elif kind == "claim_step" and ev.get("step") in funnel and ev.get("uid") is not None:
+            funnel[ev["step"]].add(ev["uid"])
+
+    lines = ["== События =="]
+    for kind, cnt in kinds.most_common():
+        lines.append(f"{kind:<16} {cnt}")
+
+    lines.append(f"\n== Топ-{top} запросов ==")
+    for q, cnt in queries.most_common(top):
+        lines.append(f"{cnt:>6}  {q}")
+
+    lines.append("\n== Время ответа, мс (p50 / p90 / p99 / max) ==")
+    for kind in QUERY_EVENTS:
+        values = sorted(latencies.get(kind, []))
+        if not values:
+            continue
+        lines.append(
+            f"{kind:<16} n={len(values)} ошибок={failures[kind]}  "
+            f"{percentile(values, 50)} / {percentile(values, 90)} / {percentile(values, 99)} / {values[-1]}"
+        )
+
+    lines.append("\n== Воронка претензии (уникальные пользователи) ==")
+    prev = None
+    for step in CLAIM_FUNNEL:
+        users = len(funnel[step])
+        drop = ""
+        if prev:
+            drop = f"  отвал {100 * (prev - users) / prev:.1f}%"
+        lines.append(f"{step:<10} {users}{drop}")
+        prev = users
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отчёт по аналитике MarketSafe")
+    parser.add_argument("paths", nargs="*", default=[os.getenv("ANALYTICS_DIR", "analytics")],
+                        help="файлы или каталоги с events-*.jsonl[.gz]")
+    parser.add_argument("--top", type=int, default=10, help="сколько популярных запросов показать")
+    args = parser.parse_args()
+    print(build_report(args.paths, top=args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,17 @@ import logging
 import textwrap
 import json
 import os
+import io
+import hashlib
+import zipfile
+import gzip
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
 from datetime import datetime, timedelta
+from xml.sax.saxutils import escape as xml_escape
 
 import aiohttp
 from bs4 import BeautifulSoup
@@ -22,7 +32,8 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import LabeledPrice, PreCheckoutQuery, ContentType
+from aiogram.types import LabeledPrice, PreCheckoutQuery, ContentType, BufferedInputFile
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramBadRequest
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -34,8 +45,32 @@ PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN", "")  # <-- вставь live_... к
 
 # Файлы для хранения
 PREMIUM_DB_FILE = "premium_users.json"
+USERS_DB_FILE = "users.json"
+BROADCAST_STATE_FILE = "broadcast_state.json"
 PAYMENTS_LOG_FILE = "payments.log"
 
+# Админы (через запятую), которым доступна рассылка /broadcast
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x.isdigit()}
+
+# Рассылка: глобальный лимит Telegram ~30 сообщений/с, держим запас
+BROADCAST_RATE = 25
+BROADCAST_CONCURRENCY = 10
+BROADCAST_CHECKPOINT_EVERY = 100
+BROADCAST_EXPIRING_DAYS = 3
+
+# Старт после рестарта: сначала разбираем накопившиеся апдейты (платежи вперёд, дубли нажатий схлопываем)
+ALLOWED_UPDATES = ["message", "callback_query", "pre_checkout_query"]
+BACKLOG_REPLAY = os.getenv("BACKLOG_REPLAY", "1") == "1"
+BACKLOG_CONCURRENCY = 8
+
+# Аналитика запросов (JSONL-события, см. analytics_report.py)
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "analytics")
+ANALYTICS_GZIP = os.getenv("ANALYTICS_GZIP", "1") == "1"
+ANALYTICS_FLUSH_SEC = 5
+ANALYTICS_BATCH_SIZE = 200
+ANALYTICS_MAX_BYTES = 5 * 1024 * 1024
+ANALYTICS_ROTATE_SEC = 24 * 3600
+
 # ---------------- LOGGING ----------------
 logging.basicConfig(
     level=logging.INFO,
@@ -51,6 +86,110 @@ if not payments_logger.handlers:
     payments_logger.addHandler(ph)
     payments_logger.setLevel(logging.INFO)
 
+# ---------------- ANALYTICS ----------------
+class AnalyticsLog:
+    """
+    Буферизованный журнал событий: события копятся в памяти и сбрасываются фоновой задачей
+    раз в ANALYTICS_FLUSH_SEC секунд или при наполнении буфера. Файл ротируется по размеру
+    и по времени, закрытые файлы при необходимости сжимаются в .gz.
+    """
+
+    def __init__(self, directory: str, use_gzip: bool = True):
+        self.directory = directory
+        self.use_gzip = use_gzip
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._path = None
+        self._opened_at = 0.0
+        self._seq = 0
+
+    def event(self, kind: str, **fields):
+        rec = {"ts": round(time.time(), 3), "ev": kind}
+        rec.update({k: v for k, v in fields.items() if v is not None})
+        self._buffer.append(rec)
+        if len(self._buffer) >= ANALYTICS_BATCH_SIZE:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await asyncio.to_thread(self._close_current)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=ANALYTICS_FLUSH_SEC)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as ex:
+                logger.exception("Analytics flush error: %s", ex)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            await asyncio.to_thread(self._write, batch)
+
+    def _write(self, batch):
+        if self._path is None or self._needs_rotation():
+            self._close_current()
+            os.makedirs(self.directory, exist_ok=True)
+            self._path = self._new_path()
+            self._opened_at = time.time()
+        lines = "".join(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n" for rec in batch)
+        with open(self._path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    def _new_path(self) -> str:
+        # микросекунды + номер файла в процессе: ротация в ту же секунду не даёт совпадения имён
+        while True:
+            self._seq += 1
+            stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+            path = os.path.join(self.directory, f"events-{stamp}-{self._seq:04d}.jsonl")
+            if not os.path.exists(path) and not os.path.exists(path + ".gz"):
+                return path
+
+    def _needs_rotation(self) -> bool:
+        if time.time() - self._opened_at >= ANALYTICS_ROTATE_SEC:
+            return True
+        try:
+            return os.path.getsize(self._path) >= ANALYTICS_MAX_BYTES
+        except OSError:
+            return False
+
+    def _close_current(self):
+        path, self._path = self._path, None
+        if not path or not self.use_gzip or not os.path.exists(path):
+            return
+        try:
+            if os.path.exists(path + ".gz"):
+                # существующий архив не перезаписываем — оставляем файл несжатым
+                logger.warning("Analytics archive %s.gz already exists, keeping %s uncompressed", path, path)
+                return
+            with open(path, "rb") as src, gzip.open(path + ".gz", "xb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(path)
+        except Exception as ex:
+            logger.exception("Analytics gzip error for %s: %s", path, ex)
+
+analytics = AnalyticsLog(ANALYTICS_DIR, use_gzip=ANALYTICS_GZIP)
+
 # ---------------- INIT ----------------
 # parse_mode через DefaultBotProperties — совместимо с aiogram 3.12.0
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="Markdown"))
@@ -67,6 +206,7 @@ class ClaimForm(StatesGroup):
     defect = State()
     demand = State()
     amount = State()
+    quick = State()   # вся претензия одним сообщением
 
 class AIStates(StatesGroup):
     question = State()
@@ -161,6 +301,19 @@ def ai_input_kb():
     kb.append([types.InlineKeyboardButton(text="Отменить", callback_data="ai_cancel")])
     return types.InlineKeyboardMarkup(inline_keyboard=kb)
 
+def claim_start_kb():
+    kb = [[types.InlineKeyboardButton(text="⚡ Заполнить одним сообщением", callback_data="claim_quick")]]
+    return types.InlineKeyboardMarkup(inline_keyboard=kb)
+
+def claim_download_kb(digest: str):
+    short = digest[:16]
+    kb = [
+        [types.InlineKeyboardButton(text="📄 Скачать DOCX", callback_data=f"claimdoc_docx_{short}"),
+         types.InlineKeyboardButton(text="📝 Скачать TXT", callback_data=f"claimdoc_txt_{short}")],
+        [types.InlineKeyboardButton(text="◀️ Главное меню", callback_data="menu_main")]
+    ]
+    return types.InlineKeyboardMarkup(inline_keyboard=kb)
+
 # ---------------- VALIDATORS ----------------
 def validate_date_ddmmyyyy(s: str) -> bool:
     return bool(re.match(r"^\d{2}\.\d{2}\.\d{4}$", s.strip()))
@@ -211,6 +364,495 @@ def has_premium(user_id: int) -> bool:
     except Exception:
         return False
 
+# ---------------- USERS STORAGE ----------------
+_known_users = None
+_users_db_readonly = False   # файл не прочитался — не перезаписываем его неполным набором
+
+def load_users_db():
+    """
+    Возвращает множество id пользователей или None, если файл есть, но прочитать его не удалось.
+    """
+    try:
+        if os.path.exists(USERS_DB_FILE):
+            with open(USERS_DB_FILE, "r", encoding="utf-8") as f:
+                return set(json.load(f))
+        return set()
+    except Exception as ex:
+        logger.exception("Failed to load users DB: %s", ex)
+        return None
+
+def save_users_db(users):
+    if _users_db_readonly:
+        return
+    try:
+        tmp = USERS_DB_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(sorted(users), f)
+        os.replace(tmp, USERS_DB_FILE)
+    except Exception as ex:
+        logger.exception("Failed to save users DB: %s", ex)
+
+def known_users():
+    global _known_users, _users_db_readonly
+    if _known_users is None:
+        users = load_users_db()
+        if users is None:
+            logger.error("Users DB %s is unreadable — new users won't be saved until it is fixed", USERS_DB_FILE)
+            _users_db_readonly = True
+            users = set()
+        _known_users = users
+    return _known_users
+
+def remember_user(user_id: int):
+    users = known_users()
+    if user_id not in users:
+        users.add(user_id)
+        save_users_db(users)
+
+def forget_users(user_ids):
+    users = known_users()
+    before = len(users)
+    users.difference_update(user_ids)
+    if len(users) != before:
+        save_users_db(users)
+
+# ---------------- BROADCAST ----------------
+_broadcast_job = None    # текущее состояние рассылки (то же, что в BROADCAST_STATE_FILE)
+_broadcast_task = None
+
+class RateLimiter:
+    """
+    Глобальный лимит отправки: не больше `rate` вызовов в секунду на все корутины.
+    pause() останавливает всех отправителей сразу (например, по RetryAfter от Telegram).
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._lock = asyncio.Lock()
+        self._next = 0.0
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+    async def wait(self):
+        async with self._lock:
+            # _next может сдвинуться вперёд через pause(), пока мы спим — перепроверяем
+            while True:
+                now = time.monotonic()
+                if self._next <= now:
+                    break
+                await asyncio.sleep(self._next - now)
+            self._next = now + self.interval
+
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+
+def broadcast_targets(audience: str):
+    premium = load_premium_db()
+    now = datetime.utcnow()
+    if audience == "all":
+        ids = set(known_users()) | {int(uid) for uid in premium}
+    else:
+        ids = set()
+        for uid, rec in premium.items():
+            try:
+                until = datetime.fromisoformat(rec["premium_until"])
+            except Exception:
+                continue
+            if audience == "premium" and until > now:
+                ids.add(int(uid))
+            elif audience == "expiring" and now < until <= now + timedelta(days=BROADCAST_EXPIRING_DAYS):
+                ids.add(int(uid))
+    return sorted(ids)
+
+def save_broadcast_state(job):
+    try:
+        tmp = BROADCAST_STATE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp, BROADCAST_STATE_FILE)
+    except Exception as ex:
+        logger.exception("Failed to save broadcast state: %s", ex)
+
+def load_broadcast_state():
+    try:
+        if os.path.exists(BROADCAST_STATE_FILE):
+            with open(BROADCAST_STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+    except Exception as ex:
+        logger.exception("Failed to load broadcast state: %s", ex)
+    return None
+
+async def _broadcast_send(uid: int, text: str) -> str:
+    """
+    Отправляет одно сообщение с учётом глобального лимита. Возвращает delivered/blocked/failed.
+    """
+    for _ in range(3):
+        await broadcast_limiter.wait()
+        try:
+            await bot.send_message(uid, text, parse_mode="HTML")
+            return "delivered"
+        except TelegramRetryAfter as ex:
+            logger.warning("Broadcast flood limit, pausing all senders for %s s", ex.retry_after)
+            broadcast_limiter.pause(ex.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as ex:
+            if "chat not found" in str(ex).lower():
+                return "blocked"
+            logger.warning("Broadcast to %s failed: %s", uid, ex)
+            return "failed"
+        except Exception as ex:
+            logger.warning("Broadcast to %s failed: %s", uid, ex)
+            return "failed"
+    return "failed"
+
+async def run_broadcast(job):
+    """
+    Рассылает job["text"] по job["targets"] начиная с job["cursor"] пачками по BROADCAST_CONCURRENCY.
+    Прогресс периодически сохраняется в BROADCAST_STATE_FILE, поэтому после рестарта рассылка
+    продолжается с последней контрольной точки (не более BROADCAST_CHECKPOINT_EVERY повторов).
+    """
+    targets = job["targets"]
+    job["status"] = "running"
+    job["run_started"] = time.time()
+    job["run_cursor"] = job["cursor"]
+    save_broadcast_state(job)
+    logger.info("Broadcast %s: %s/%s, audience=%s", job["id"], job["cursor"], len(targets), job["audience"])
+    since_checkpoint = 0
+    try:
+        while job["cursor"] < len(targets) and job["status"] == "running":
+            batch = targets[job["cursor"]:job["cursor"] + BROADCAST_CONCURRENCY]
+            results = await asyncio.gather(*(_broadcast_send(uid, job["text"]) for uid in batch))
+            blocked = [uid for uid, res in zip(batch, results) if res == "blocked"]
+            job["delivered"] += results.count("delivered")
+            job["failed"] += results.count("failed")
+            job["blocked"] += len(blocked)
+            if blocked:
+                forget_users(blocked)
+            job["cursor"] += len(batch)
+            since_checkpoint += len(batch)
+            if since_checkpoint >= BROADCAST_CHECKPOINT_EVERY:
+                save_broadcast_state(job)
+                since_checkpoint = 0
+        if job["status"] == "running":
+            job["status"] = "done"
+    finally:
+        save_broadcast_state(job)
+        analytics.event("broadcast", id=job["id"], status=job["status"], delivered=job["delivered"],
+                        failed=job["failed"], blocked=job["blocked"], total=len(targets))
+        logger.info("Broadcast %s %s: delivered=%s failed=%s blocked=%s", job["id"], job["status"],
+                    job["delivered"], job["failed"], job["blocked"])
+
+def start_broadcast(job):
+    global _broadcast_job, _broadcast_task
+    _broadcast_job = job
+    _broadcast_task = asyncio.create_task(run_broadcast(job))
+
+def resume_broadcast():
+    job = load_broadcast_state()
+    if job and job.get("status") == "running" and job["cursor"] < len(job["targets"]):
+        start_broadcast(job)
+
+async def stop_broadcast():
+    # статус остаётся "running" — после рестарта рассылка продолжится с контрольной точки
+    if broadcast_running():
+        _broadcast_task.cancel()
+        try:
+            await _broadcast_task
+        except asyncio.CancelledError:
+            pass
+
+def broadcast_running() -> bool:
+    return _broadcast_task is not None and not _broadcast_task.done()
+
+def broadcast_status_text(job) -> str:
+    total = len(job["targets"])
+    remaining = total - job["cursor"]
+    eta = "—"
+    sent_this_run = job["cursor"] - job.get("run_cursor", 0)
+    elapsed = time.time() - job.get("run_started", time.time())
+    if job["status"] == "running" and sent_this_run > 0 and elapsed > 0:
+        eta = f"~{int(remaining * elapsed / sent_this_run)} с"
+    return (
+        f"📣 Рассылка `{job['id']}` ({job['audience']}): *{job['status']}*\n"
+        f"Доставлено: {job['delivered']}\n"
+        f"Ошибок: {job['failed']}\n"
+        f"Заблокировали бота (удалены): {job['blocked']}\n"
+        f"Осталось: {remaining} из {total}\n"
+        f"ETA: {eta}"
+    )
+
+# ---------------- CLAIM RENDERING ----------------
+# Поля претензии в порядке заполнения ClaimForm
+CLAIM_FIELDS = ("fio", "contact", "seller", "order_id", "date", "product", "defect", "demand", "amount")
+
+# Данные маркетплейсов — подставляются в шаблон один раз при старте.
+# hint — совет в сообщении бота, куда отправить претензию (в сам документ не попадает)
+CLAIM_SELLERS = {
+    "ozon": {
+        "seller_title": "Ozon",
+        "addressee": "Продавцу товара на площадке Ozon",
+        "hint": "Отправьте претензию продавцу через чат в разделе «Заказы» → «Связаться с продавцом» на Ozon.",
+    },
+    "wb": {
+        "seller_title": "Wildberries",
+        "addressee": "Продавцу товара на площадке Wildberries",
+        "hint": "Отправьте претензию через раздел «Обращения» в личном кабинете Wildberries.",
+    },
+    "yandex": {
+        "seller_title": "Yandex.Market",
+        "addressee": "Продавцу товара на площадке Yandex.Market",
+        "hint": "Отправьте претензию продавцу через чат с магазином в заказе на Yandex.Market.",
+    },
+}
+CLAIM_DEFAULT_SELLER = {"seller_title": "продавца", "addressee": "Продавцу", "hint": ""}
+
+CLAIM_TEMPLATE_MD = (
+    "📄 *Претензия продавцу*\n\n"
+    "*Кому:* $addressee\n"
+    "*От:* $$fio ($$contact)\n"
+    "*Заказ №:* $$order_id от $$date\n\n"
+    "*Товар:* $$product\n"
+    "*Описание проблемы:* $$defect\n"
+    "*Требование:* $$demand\n"
+    "*Сумма к возврату:* $$amount руб.\n\n"
+    "Дата составления: $$created\n\n"
+    "Прошу удовлетворить требования в соответствии с законом о защите прав потребителей."
+)
+
+CLAIM_TEMPLATE_TXT = (
+    "ПРЕТЕНЗИЯ\n\n"
+    "Кому: $addressee\n"
+    "От: $$fio\n"
+    "Контакт: $$contact\n\n"
+    "Заказ № $$order_id от $$date на площадке $seller_title.\n"
+    "Товар: $$product\n\n"
+    "Описание проблемы: $$defect\n\n"
+    "На основании Закона РФ «О защите прав потребителей» требую: $$demand.\n"
+    "Сумма к возврату: $$amount руб.\n\n"
+    "Ответ прошу направить в течение 10 дней по указанному контакту.\n\n"
+    "Дата составления: $$created\n"
+    "Подпись: ____________ / $$fio"
+)
+
+def _compile_claim_templates():
+    """
+    Предкомпилирует шаблоны для каждого маркетплейса: реквизиты площадки подставляются сразу,
+    а поля пользователя остаются плейсхолдерами ($$field → $field).
+    """
+    compiled = {}
+    for key, seller in list(CLAIM_SELLERS.items()) + [("default", CLAIM_DEFAULT_SELLER)]:
+        compiled[key] = {
+            "md": Template(Template(CLAIM_TEMPLATE_MD).substitute(seller)),
+            "txt": Template(Template(CLAIM_TEMPLATE_TXT).substitute(seller)),
+        }
+    return compiled
+
+CLAIM_TEMPLATES = _compile_claim_templates()
+
+# Рендер идёт в пуле потоков, чтобы не блокировать event loop
+CLAIM_RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="claim-render")
+CLAIM_CACHE_SIZE = 256
+_claim_render_cache = OrderedDict()   # (digest, fmt) -> bytes
+_claim_data_cache = OrderedDict()     # digest -> поля претензии
+
+def claim_fields(data: dict) -> dict:
+    fields = {k: str(data.get(k, "")) for k in CLAIM_FIELDS}
+    fields["created"] = str(data.get("created") or datetime.now().strftime("%d.%m.%Y"))
+    return fields
+
+def claim_digest(fields: dict) -> str:
+    raw = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _cache_put(cache: OrderedDict, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CLAIM_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def _build_docx(text: str) -> bytes:
+    """
+    Минимальный DOCX (WordprocessingML) без внешних зависимостей: по абзацу на строку.
+    """
+    paragraphs = []
+    for i, line in enumerate(text.split("\n")):
+        bold = "<w:rPr><w:b/></w:rPr>" if i == 0 else ""
+        paragraphs.append(
+            f'<w:p><w:r>{bold}<w:t xml:space="preserve">{xml_escape(line)}</w:t></w:r></w:p>'
+        )
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f'<w:body>{"".join(paragraphs)}</w:body></w:document>'
+    )
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '</Types>'
+    )
+    rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="word/document.xml"/>'
+        '</Relationships>'
+    )
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", content_types)
+        zf.writestr("_rels/.rels", rels)
+        zf.writestr("word/document.xml", document)
+    return buf.getvalue()
+
+def _render_claim_sync(fields: dict, fmt: str) -> bytes:
+    templates = CLAIM_TEMPLATES.get(fields.get("seller", ""), CLAIM_TEMPLATES["default"])
+    if fmt == "md":
+        # Markdown-версия для сообщения в чате — экранируем как раньше
+        safe = {k: html.escape(v) for k, v in fields.items()}
+        return templates["md"].safe_substitute(safe).encode("utf-8")
+    text = templates["txt"].safe_substitute(fields)
+    if fmt == "docx":
+        return _build_docx(text)
+    return text.encode("utf-8")
+
+async def render_claim(data: dict, fmt: str = "txt"):
+    """
+    Рендерит претензию в формат md/txt/docx. Возвращает (digest, bytes).
+    Повторный запрос с теми же данными отдаётся из кэша по хэшу содержимого.
+    """
+    fields = claim_fields(data)
+    digest = claim_digest(fields)
+    _cache_put(_claim_data_cache, digest, fields)
+    key = (digest, fmt)
+    cached = _claim_render_cache.get(key)
+    if cached is not None:
+        _claim_render_cache.move_to_end(key)
+        return digest, cached
+    loop = asyncio.get_running_loop()
+    content = await loop.run_in_executor(CLAIM_RENDER_EXECUTOR, _render_claim_sync, fields, fmt)
+    _cache_put(_claim_render_cache, key, content)
+    return digest, content
+
+def find_claim_fields(short_digest: str):
+    for digest, fields in reversed(_claim_data_cache.items()):
+        if digest.startswith(short_digest):
+            return fields
+    return None
+
+# ---------------- CLAIM PARSER ----------------
+CLAIM_QUICK_TEMPLATE = (
+    "ФИО: Иванов Иван Иванович\n"
+    "Контакт: +7 912 123-45-67\n"
+    "Магазин: Ozon\n"
+    "Заказ: 12345678-0001\n"
+    "Дата: 25.10.2025\n"
+    "Товар: Беспроводные наушники\n"
+    "Проблема: не работает левый наушник\n"
+    "Требование: возврат\n"
+    "Сумма: 2490"
+)
+
+# Подписи полей в сообщении «Поле: значение» (регистр не важен)
+CLAIM_LABELS = {
+    "fio": ("фио", "имя", "покупатель"),
+    "contact": ("контакт", "телефон", "тел", "e-mail", "email", "почта"),
+    "seller": ("магазин", "маркетплейс", "продавец", "площадка"),
+    "order_id": ("номер заказа", "заказ", "артикул"),
+    "date": ("дата покупки", "дата заказа", "дата"),
+    "product": ("товар", "наименование"),
+    "defect": ("проблема", "описание", "дефект", "недостаток"),
+    "demand": ("требование", "требую"),
+    "amount": ("сумма", "сумма к возврату", "стоимость"),
+}
+CLAIM_FIELD_TITLES = {
+    "fio": "ФИО", "contact": "контакт", "seller": "магазин", "order_id": "номер заказа", "date": "дата",
+    "product": "товар", "defect": "проблема", "demand": "требование", "amount": "сумма",
+}
+_CLAIM_LABEL_RE = re.compile(
+    r"^\s*(" + "|".join(sorted({re.escape(l) for ls in CLAIM_LABELS.values() for l in ls}, key=len, reverse=True))
+    + r")\s*(?:№|#)?\s*[:\-—–]\s*(.+?)\s*$",
+    re.IGNORECASE,
+)
+_LABEL_TO_FIELD = {l: f for f, ls in CLAIM_LABELS.items() for l in ls}
+
+SELLER_ALIASES = {
+    "ozon": ("ozon", "озон"),
+    "wb": ("wildberries", "вайлдберриз", "валдберис", "wb"),
+    "yandex": ("yandex", "яндекс"),
+}
+
+def parse_seller(text: str):
+    t = text.lower()
+    for key, aliases in SELLER_ALIASES.items():
+        if any(re.search(rf"(?<![\w]){re.escape(a)}", t) for a in aliases):
+            return key
+    return None
+
+def _guess_unlabeled(text: str) -> dict:
+    """
+    Эвристики для пересланного письма/уведомления о заказе, где поля не подписаны.
+    """
+    found = {}
+    m = re.search(r"заказ\w*\s*(?:№|#|N)?\s*([A-Za-z0-9][\w\-]{3,})", text, re.IGNORECASE)
+    if m:
+        found["order_id"] = m.group(1)
+    m = re.search(r"\b\d{2}\.\d{2}\.\d{4}\b", text)
+    if m:
+        found["date"] = m.group(0)
+    m = re.search(r"(?:итого|к оплате|оплачено|сумма)\D{0,20}?(\d[\d\s\u00a0]*)(?:[.,]\d{2})?\s*(?:₽|руб)", text, re.IGNORECASE)
+    if m:
+        found["amount"] = m.group(1)
+    seller = parse_seller(text)
+    if seller:
+        found["seller"] = seller
+    return found
+
+def parse_claim_message(text: str):
+    """
+    Разбирает претензию из одного сообщения. Возвращает (поля, ошибки): в поля попадает только то,
+    что прошло те же проверки, что и пошаговая форма; ошибки — список названий неверных полей.
+    """
+    raw = {}
+    for line in text.splitlines():
+        m = _CLAIM_LABEL_RE.match(line)
+        if m:
+            raw.setdefault(_LABEL_TO_FIELD[m.group(1).lower()], m.group(2))
+    for k, v in _guess_unlabeled(text).items():
+        raw.setdefault(k, v)
+
+    fields, errors = {}, []
+    for key, value in raw.items():
+        value = value.strip()
+        if key == "fio":
+            ok = len(value) >= 3
+            value = " ".join(w.capitalize() for w in value.split())
+        elif key == "contact":
+            ok = validate_contact(value)
+        elif key == "seller":
+            value = parse_seller(value)
+            ok = value is not None
+        elif key == "order_id":
+            value = value.split()[0] if value else value
+            ok = len(value) >= 2
+        elif key == "date":
+            ok = validate_date_ddmmyyyy(value)
+        elif key == "amount":
+            value = re.sub(r"[\s\u00a0]|руб\.?|₽", "", value)
+            ok = validate_amount(value)
+        else:
+            ok = bool(value)
+        if ok:
+            fields[key] = value
+        else:
+            errors.append(key)
+    return fields, errors
+
 # ---------------- WEB SEARCH ----------------
 async def web_search_snippets(query: str, limit: int = 4, timeout: int = 10):
     """
@@ -301,6 +943,7 @@ async def smart_web_answer(query: str, limit: int = 4):
 # ---------------- HANDLERS ----------------
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
+    remember_user(message.from_user.id)
     welcome = (
         "👋 *Привет!* Я — *MarketSafe* — помощник по возвратам, претензиям и правам.\n\n"
         "Выбери раздел в меню ниже или напиши /cancel для отмены текущего действия."
@@ -312,9 +955,67 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer("Действие отменено. Возвращаю в главное меню.", reply_markup=main_menu())
 
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    parts = (message.text or "").split(maxsplit=2)
+    if len(parts) < 3 or parts[1] not in ("all", "premium", "expiring"):
+        await message.answer("Использование: /broadcast all|premium|expiring <текст сообщения>")
+        return
+    if broadcast_running():
+        await message.answer("⚠️ Рассылка уже идёт. /broadcast\\_status — прогресс, /broadcast\\_cancel — остановить.")
+        return
+    targets = broadcast_targets(parts[1])
+    if not targets:
+        await message.answer("Получателей не найдено.")
+        return
+    # текст берём с разметкой админа в HTML — так он не сломается на непарных _ или *
+    text = message.html_text.split(maxsplit=2)[2]
+    try:
+        await message.answer(text, parse_mode="HTML")
+    except TelegramBadRequest as ex:
+        await message.answer(f"❌ Telegram не принял текст рассылки: {ex}", parse_mode=None)
+        return
+    job = {
+        "id": datetime.utcnow().strftime("%Y%m%d-%H%M%S"),
+        "audience": parts[1],
+        "text": text,
+        "targets": targets,
+        "cursor": 0,
+        "delivered": 0,
+        "failed": 0,
+        "blocked": 0,
+        "status": "running",
+    }
+    start_broadcast(job)
+    await message.answer(f"📣 Рассылка запущена (выше — превью): {len(targets)} получателей. Прогресс — /broadcast\\_status")
+
+@dp.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    job = _broadcast_job or load_broadcast_state()
+    if not job:
+        await message.answer("Рассылок ещё не было.")
+        return
+    await message.answer(broadcast_status_text(job))
+
+@dp.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if not broadcast_running():
+        await message.answer("Активной рассылки нет.")
+        return
+    _broadcast_job["status"] = "cancelled"
+    await message.answer("⏹ Рассылка будет остановлена после текущей пачки.")
+
 @dp.callback_query()
 async def cb_menu_handler(query: types.CallbackQuery, state: FSMContext):
     data = query.data or ""
+    analytics.event("callback", uid=query.from_user.id, data=data)
+    remember_user(query.from_user.id)
     try:
         # Основные разделы — без изменений (твоя логика)
         if data == "menu_delivery":
@@ -341,8 +1042,19 @@ async def cb_menu_handler(query: types.CallbackQuery, state: FSMContext):
             await query.message.answer(text, reply_markup=main_menu())
 
         elif data == "menu_generate_claim":
-            await query.message.answer("✍️ Давай составим претензию. Введите, пожалуйста, полное ФИО (например: Иванов Иван Иванович):")
+            await query.message.answer("✍️ Давай составим претензию. Введите, пожалуйста, полное ФИО (например: Иванов Иван Иванович):\n\n"
+                                       "Или заполните всё сразу одним сообщением / перешлите письмо о заказе.",
+                                       reply_markup=claim_start_kb())
+            await state.set_data({})
             await state.set_state(ClaimForm.fio)
+            analytics.event("claim_step", uid=query.from_user.id, step="start")
+
+        elif data == "claim_quick":
+            await state.set_data({})
+            await state.set_state(ClaimForm.quick)
+            await query.message.answer("⚡ Отправьте претензию одним сообщением по образцу (можно не все поля — "
+                                       "недостающие я спрошу) или перешлите письмо/уведомление о заказе:\n\n"
+                                       f"```\n{CLAIM_QUICK_TEMPLATE}\n```")
 
         elif data == "menu_claim":
             await query.message.answer("✍️ Нужна помощь с претензией? Нажми «✍️ Автогенератор претензии» для пошагового заполнения.", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
@@ -366,8 +1078,19 @@ async def cb_menu_handler(query: types.CallbackQuery, state: FSMContext):
         elif data.startswith("seller_"):
             seller = data.split("_", 1)[1]
             await state.update_data(seller=seller)
-            await state.set_state(ClaimForm.order_id)
-            await query.message.answer("Введите номер заказа (или артикул):")
+            await advance_claim(query.message, state)
+
+        # скачать сформированную претензию документом
+        elif data.startswith("claimdoc_"):
+            _, fmt, short = data.split("_", 2)
+            fields = find_claim_fields(short)
+            if not fields or fmt not in ("docx", "txt"):
+                await query.message.answer("Претензия устарела — сформируйте её заново.", reply_markup=main_menu())
+            else:
+                _, content = await render_claim(fields, fmt)
+                filename = f"pretenziya_{fields.get('order_id') or 'claim'}.{fmt}"
+                filename = re.sub(r"[^\w\.\-]", "_", filename)
+                await query.message.answer_document(BufferedInputFile(content, filename=filename))
 
         # AI
         elif data == "menu_ask_ai":
@@ -392,6 +1115,7 @@ async def cb_menu_handler(query: types.CallbackQuery, state: FSMContext):
                 idx = int(data.split("_")[1])
                 qtext = EXAMPLE_QUESTIONS[idx]
                 await query.message.answer(f"🔎 Обрабатываю пример: {qtext}")
+                started = time.monotonic()
                 is_legal = any(k in qtext.lower() for k in ["закон","статья","возврат","брак","гарантия","обмен","нарушение"])
                 if is_legal:
                     legal = legal_analyzer(qtext)
@@ -400,6 +1124,8 @@ async def cb_menu_handler(query: types.CallbackQuery, state: FSMContext):
                 else:
                     ans = await smart_web_answer(qtext, limit=4)
                     await query.message.answer(ans, disable_web_page_preview=True, reply_markup=main_menu())
+                analytics.event("example_query", uid=query.from_user.id, q=qtext, legal=is_legal,
+                                ms=int((time.monotonic() - started) * 1000))
             except Exception as ex:
                 logger.exception("example_ handler error: %s", ex)
                 await query.message.answer("Не удалось обработать пример.", reply_markup=main_menu())
@@ -469,16 +1195,82 @@ async def cb_menu_handler(query: types.CallbackQuery, state: FSMContext):
             pass
 
 # ---------------- CLAIM FORM STEPS ----------------
+CLAIM_PROMPTS = {
+    "fio": "Введите, пожалуйста, полное ФИО (например: Иванов Иван Иванович):",
+    "contact": "Введите контакт (телефон или e-mail). Пример: +7 912 123-45-67 или user@example.com",
+    "seller": "Выберите магазин:",
+    "order_id": "Введите номер заказа (или артикул):",
+    "date": "Введите дату покупки в формате ДД.MM.ГГГГ (например: 25.10.2025)",
+    "product": "Напишите название товара (коротко):",
+    "defect": "Кратко опишите проблему (1–3 предложения):",
+    "demand": "Что вы требуете? (возврат / обмен / ремонт / компенсация)",
+    "amount": "Укажите сумму к возврату (только цифры, 0 если нет):",
+}
+
+async def advance_claim(message: types.Message, state: FSMContext, prefix: str = ""):
+    """
+    Переводит форму на первое незаполненное поле; если заполнено всё — формирует претензию.
+    """
+    data = await state.get_data()
+    missing = [f for f in CLAIM_FIELDS if not data.get(f)]
+    # воронка: шаг считается пройденным, когда заполнены все поля до него по порядку формы,
+    # поэтому и быстрый ввод, и пошаговый дают события в одном порядке
+    filled = CLAIM_FIELDS.index(missing[0]) if missing else len(CLAIM_FIELDS)
+    reported = data.get("funnel_pos", 0)
+    if filled > reported:
+        for field in CLAIM_FIELDS[reported:filled]:
+            analytics.event("claim_step", uid=state.key.user_id, step=field)
+        await state.update_data(funnel_pos=filled)
+    if not missing:
+        await finish_claim(message, state)
+        return
+    field = missing[0]
+    await state.set_state(getattr(ClaimForm, field))
+    markup = seller_buttons() if field == "seller" else None
+    await message.answer(prefix + CLAIM_PROMPTS[field], reply_markup=markup)
+
+async def finish_claim(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    data["created"] = datetime.now().strftime("%d.%m.%Y")
+    digest, claim_md = await render_claim(data, "md")
+    analytics.event("claim_step", uid=state.key.user_id, step="claim_done", seller=data.get("seller"))
+
+    await message.answer(claim_md.decode("utf-8"))
+    await state.clear()
+    hint = CLAIM_SELLERS.get(data.get("seller"), CLAIM_DEFAULT_SELLER)["hint"]
+    await message.answer("📎 Претензию можно скачать документом — для печати или отправки по e-mail."
+                         + (f"\n\n💡 {hint}" if hint else ""), reply_markup=claim_download_kb(digest))
+    await message.answer("Готово — претензия сформирована. Возвращаю в главное меню.", reply_markup=main_menu())
+
+@dp.message(ClaimForm.quick)
+async def step_quick(message: types.Message, state: FSMContext):
+    text = (message.text or message.caption or "").strip()
+    fields, errors = parse_claim_message(text)
+    await state.update_data(**fields)
+    analytics.event("claim_quick", uid=message.from_user.id, parsed=len(fields), invalid=len(errors))
+
+    lines = []
+    if fields:
+        lines.append("✅ Распознано: " + ", ".join(CLAIM_FIELD_TITLES[f] for f in CLAIM_FIELDS if f in fields) + ".")
+    else:
+        lines.append("Не удалось распознать поля — заполним по шагам.")
+    if errors:
+        lines.append("⚠️ Неверный формат: " + ", ".join(CLAIM_FIELD_TITLES[f] for f in CLAIM_FIELDS if f in errors) + ".")
+    await advance_claim(message, state, prefix="\n".join(lines) + "\n\n")
+
 @dp.message(ClaimForm.fio)
 async def step_fio(message: types.Message, state: FSMContext):
-    text = message.text.strip()
+    text = (message.text or "").strip()
+    # пересланное письмо о заказе или несколько полей сразу — разбираем целиком
+    if message.forward_origin is not None or len(parse_claim_message(text)[0]) >= 2:
+        await step_quick(message, state)
+        return
     if len(text) < 3:
         await message.answer("❌ Введите корректное ФИО (минимум 3 символа).")
         return
     fio_clean = " ".join(w.capitalize() for w in text.split())
     await state.update_data(fio=fio_clean)
-    await state.set_state(ClaimForm.contact)
-    await message.answer("Введите контакт (телефон или e-mail). Пример: +7 912 123-45-67 или user@example.com")
+    await advance_claim(message, state)
 
 @dp.message(ClaimForm.contact)
 async def step_contact(message: types.Message, state: FSMContext):
@@ -487,7 +1279,16 @@ async def step_contact(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный формат контакта. Укажите корректный телефон или email.")
         return
     await state.update_data(contact=c)
-    await message.answer("Выберите магазин:", reply_markup=seller_buttons())
+    await advance_claim(message, state)
+
+@dp.message(ClaimForm.seller)
+async def step_seller(message: types.Message, state: FSMContext):
+    seller = parse_seller(message.text or "")
+    if not seller:
+        await message.answer("Выберите магазин кнопкой ниже:", reply_markup=seller_buttons())
+        return
+    await state.update_data(seller=seller)
+    await advance_claim(message, state)
 
 @dp.message(ClaimForm.order_id)
 async def step_order(message: types.Message, state: FSMContext):
@@ -499,8 +1300,7 @@ async def step_order(message: types.Message, state: FSMContext):
     data = await state.get_data()
     seller = data.get("seller", "не указан")
     status = f"Статус: информация о заказе не доступна (симуляция). Магазин: {seller}."
-    await state.set_state(ClaimForm.date)
-    await message.answer(f"{status}\n\nВведите дату покупки в формате ДД.MM.ГГГГ (например: 25.10.2025)")
+    await advance_claim(message, state, prefix=f"{status}\n\n")
 
 @dp.message(ClaimForm.date)
 async def step_date(message: types.Message, state: FSMContext):
@@ -508,27 +1308,23 @@ async def step_date(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный формат даты. Используйте DD.MM.YYYY")
         return
     await state.update_data(date=message.text.strip())
-    await state.set_state(ClaimForm.product)
-    await message.answer("Напишите название товара (коротко):")
+    await advance_claim(message, state)
 
 @dp.message(ClaimForm.product)
 async def step_product(message: types.Message, state: FSMContext):
     await state.update_data(product=message.text.strip())
-    await state.set_state(ClaimForm.defect)
-    await message.answer("Кратко опишите проблему (1–3 предложения):")
+    await advance_claim(message, state)
 
 @dp.message(ClaimForm.defect)
 async def step_defect(message: types.Message, state: FSMContext):
     await state.update_data(defect=message.text.strip())
-    await state.set_state(ClaimForm.demand)
-    await message.answer("Что вы требуете? (возврат / обмен / ремонт / компенсация)")
+    await advance_claim(message, state)
 
 @dp.message(ClaimForm.demand)
 async def step_demand(message: types.Message, state: FSMContext):
     d = message.text.strip()
     await state.update_data(demand=d)
-    await state.set_state(ClaimForm.amount)
-    await message.answer("Укажите сумму к возврату (только цифры, 0 если нет):")
+    await advance_claim(message, state)
 
 @dp.message(ClaimForm.amount)
 async def step_amount(message: types.Message, state: FSMContext):
@@ -537,34 +1333,7 @@ async def step_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Сумма должна содержать только цифры (например: 0 или 1500).")
         return
     await state.update_data(amount=amount_text)
-    data = await state.get_data()
-
-    seller_name = html.escape(data.get("seller", "Продавец"))
-    fio = html.escape(data.get("fio", ""))
-    contact = html.escape(data.get("contact", ""))
-    order_id = html.escape(data.get("order_id", ""))
-    date = html.escape(data.get("date", ""))
-    product = html.escape(data.get("product", ""))
-    defect = html.escape(data.get("defect", ""))
-    demand = html.escape(data.get("demand", ""))
-    amount = html.escape(data.get("amount", ""))
-
-    claim_text = (
-        f"📄 *Претензия продавцу*\n\n"
-        f"*Кому:* {seller_name}\n"
-        f"*От:* {fio} ({contact})\n"
-        f"*Заказ №:* {order_id} от {date}\n\n"
-        f"*Товар:* {product}\n"
-        f"*Описание проблемы:* {defect}\n"
-        f"*Требование:* {demand}\n"
-        f"*Сумма к возврату:* {amount} руб.\n\n"
-        f"Дата составления: {datetime.now().strftime('%d.%m.%Y')}\n\n"
-        f"Прошу удовлетворить требования в соответствии с законом о защите прав потребителей."
-    )
-
-    await message.answer(claim_text)
-    await state.clear()
-    await message.answer("Готово — претензия сформирована. Возвращаю в главное меню.", reply_markup=main_menu())
+    await advance_claim(message, state)
 
 # ---------------- AI HANDLERS ----------------
 @dp.message(AIStates.question)
@@ -574,17 +1343,23 @@ async def ai_question_handler(message: types.Message, state: FSMContext):
         await message.answer("Пустой запрос. Напишите, пожалуйста, вопрос.")
         return
     # Пример: проверка премиума для приоритета
-    if has_premium(message.from_user.id):
+    premium = has_premium(message.from_user.id)
+    if premium:
         await message.answer("🔎 (Premium) Ищу информацию с приоритетом...")
     else:
         await message.answer("🔎 Ищу информацию... (это может занять несколько секунд)")
+    started = time.monotonic()
+    ok = False
     try:
         answer = await smart_web_answer(q, limit=4)
         await message.answer(answer, disable_web_page_preview=True, reply_markup=main_menu())
+        ok = True
     except Exception as ex:
         logger.exception("AI search error: %s", ex)
         await message.answer("⚠️ Произошла ошибка при поиске. Попробуйте позже.", reply_markup=main_menu())
     finally:
+        analytics.event("ai_query", uid=message.from_user.id, q=q[:200], ok=ok,
+                        premium=premium, ms=int((time.monotonic() - started) * 1000))
         await state.clear()
 
 @dp.message(AIStates.legal)
@@ -593,19 +1368,25 @@ async def ai_legal_handler(message: types.Message, state: FSMContext):
     if not text:
         await message.answer("Опишите проблему, пожалуйста.")
         return
-    if has_premium(message.from_user.id):
+    premium = has_premium(message.from_user.id)
+    if premium:
         await message.answer("⚖️ (Premium) Анализирую юридическую сторону... ⏳")
     else:
         await message.answer("⚖️ Анализирую юридическую сторону... ⏳")
+    started = time.monotonic()
+    ok = False
     try:
         legal = legal_analyzer(text)
         web = await smart_web_answer(text, limit=3)
         combined = f"{legal}\n\n{web}"
         await message.answer(combined, disable_web_page_preview=True, reply_markup=main_menu())
+        ok = True
     except Exception as ex:
         logger.exception("Legal AI error: %s", ex)
         await message.answer("⚠️ Ошибка при анализе. Попробуйте позже.", reply_markup=main_menu())
     finally:
+        analytics.event("legal_query", uid=message.from_user.id, q=text[:200], ok=ok,
+                        premium=premium, ms=int((time.monotonic() - started) * 1000))
         await state.clear()
 
 # ---------------- PAYMENTS HANDLERS ----------------
@@ -706,6 +1487,172 @@ async def global_error_handler(update, exception):
     logger.exception("Unhandled exception: %s", exception)
     return True
 
+# ---------------- BACKLOG REPLAY ----------------
+# Нажатия, которые только показывают раздел: из серии подряд важно лишь последнее
+DISPLAY_CALLBACKS = {
+    "menu_delivery", "menu_returns", "menu_howtoreturn", "menu_claim", "menu_rights_buyer",
+    "menu_rights_seller", "menu_faq", "menu_contacts", "menu_main",
+}
+# Нажатия, которые переключают режим (FSM): из серии важно последнее, и оно сохраняется
+# независимо от показов разделов, иначе следующее сообщение попадёт не в тот обработчик
+STATE_CALLBACKS = {"menu_generate_claim", "menu_ask_ai", "menu_legal_ai", "claim_quick", "ai_cancel"}
+# Остальное (счета на оплату, example_, seller_, claimdoc_) схлопывается только при точном повторе
+
+def _update_user_id(update: types.Update):
+    for obj in (update.message, update.callback_query, update.pre_checkout_query):
+        if obj is not None and obj.from_user is not None:
+            return obj.from_user.id
+    return None
+
+def _is_payment_update(update: types.Update) -> bool:
+    return update.pre_checkout_query is not None or (
+        update.message is not None and update.message.successful_payment is not None
+    )
+
+def prioritize_backlog(updates):
+    """
+    Возвращает (платежи, остальные апдейты, число отброшенных нажатий).
+    В серии нажатий одного пользователя без сообщений между ними остаются последнее нажатие-показ
+    раздела, последнее нажатие, меняющее состояние, и по одному экземпляру одинаковых нажатий.
+    """
+    payments, kept = [], []
+    display_seen = set()  # пользователи, у которых уже есть более позднее нажатие-показ
+    state_seen = set()    # пользователи, у которых уже есть более позднее нажатие, меняющее состояние
+    taps_seen = set()     # (user, data) более поздних нажатий
+    dropped = 0
+    for upd in reversed(updates):
+        uid = _update_user_id(upd)
+        if _is_payment_update(upd):
+            payments.append(upd)
+            continue
+        cq = upd.callback_query
+        if cq is None:
+            # сообщение пользователя разрывает серию нажатий
+            display_seen.discard(uid)
+            state_seen.discard(uid)
+            taps_seen = {t for t in taps_seen if t[0] != uid}
+            kept.append(upd)
+            continue
+        data = cq.data or ""
+        group = display_seen if data in DISPLAY_CALLBACKS else state_seen if data in STATE_CALLBACKS else None
+        if (uid, data) in taps_seen or (group is not None and uid in group):
+            dropped += 1
+            continue
+        taps_seen.add((uid, data))
+        if group is not None:
+            group.add(uid)
+        kept.append(upd)
+    payments.reverse()
+    kept.reverse()
+    return payments, kept, dropped
+
+async def _feed_updates(updates):
+    for upd in updates:
+        try:
+            # backlog_replay=True — чтобы backlog_order_middleware пропустил апдейт без ожидания
+            await dp.feed_update(bot, upd, backlog_replay=True)
+        except Exception as ex:
+            logger.exception("Backlog update %s failed: %s", upd.update_id, ex)
+
+_backlog_task = None
+_backlog_chains = {}   # user_id -> {"chain": [...], "started": bool, "done": asyncio.Event}
+
+async def _run_user_chain(key):
+    """
+    Проигрывает бэклог одного пользователя ровно один раз — из фоновой задачи или из middleware,
+    если живой апдейт этого пользователя пришёл раньше, чем до него дошла очередь.
+    """
+    rec = _backlog_chains.get(key)
+    if rec is None:
+        return
+    if rec["started"]:
+        await rec["done"].wait()
+        return
+    rec["started"] = True
+    try:
+        await _feed_updates(rec["chain"])
+    finally:
+        rec["done"].set()
+        _backlog_chains.pop(key, None)
+
+@dp.update.outer_middleware()
+async def backlog_order_middleware(handler, event: types.Update, data: dict):
+    # живые апдейты пользователя ждут, пока не доиграется его бэклог — порядок сохраняется;
+    # платежи не ждут: у pre_checkout_query всего 10 секунд на ответ
+    if not data.get("backlog_replay") and _backlog_chains and not _is_payment_update(event):
+        uid = _update_user_id(event)
+        if uid in _backlog_chains:
+            await _run_user_chain(uid)
+    return await handler(event, data)
+
+async def _replay_backlog(keys, started: float, total: int, payments: int, dropped: int):
+    sem = asyncio.Semaphore(BACKLOG_CONCURRENCY)
+
+    async def feed_user(key):
+        rec = _backlog_chains.get(key)
+        if rec is None or rec["started"]:
+            return   # уже проигрывается из middleware
+        async with sem:
+            await _run_user_chain(key)
+
+    try:
+        await asyncio.gather(*(feed_user(key) for key in keys))
+    finally:
+        # при отмене освобождаем ожидающие живые апдейты
+        for rec in _backlog_chains.values():
+            rec["done"].set()
+        _backlog_chains.clear()
+    elapsed = time.monotonic() - started
+    logger.info("Backlog drained: %s updates (%s payments, %s collapsed taps, %s users) in %.1f s",
+                total, payments, dropped, len(keys), elapsed)
+    analytics.event("backlog", total=total, payments=payments, collapsed=dropped, ms=int(elapsed * 1000))
+
+async def drain_backlog():
+    """
+    Забирает накопившиеся за время простоя апдейты. Платежи и pre_checkout_query обрабатываются
+    сразу, остальное — фоновой задачей (параллельно по пользователям, в исходном порядке внутри
+    пользователя), чтобы polling стартовал без ожидания медленных поисковых запросов.
+    Живые апдейты пользователя обрабатываются только после его бэклога (backlog_order_middleware).
+    """
+    global _backlog_task
+    if _backlog_task is not None and not _backlog_task.done():
+        # прошлый бэклог ещё разбирается — новые апдейты пусть придут обычным polling
+        return
+    started = time.monotonic()
+    updates = []
+    offset = None
+    while True:
+        # каждый следующий запрос с offset подтверждает предыдущую пачку
+        batch = await bot.get_updates(offset=offset, limit=100, timeout=0, allowed_updates=ALLOWED_UPDATES)
+        if not batch:
+            break
+        updates.extend(batch)
+        offset = batch[-1].update_id + 1
+    if not updates:
+        return
+
+    payments, rest, dropped = prioritize_backlog(updates)
+    await _feed_updates(payments)
+    logger.info("Backlog: %s updates, %s payments handled in %.1f s, replaying the rest in background",
+                len(updates), len(payments), time.monotonic() - started)
+
+    for upd in rest:
+        uid = _update_user_id(upd)
+        key = uid if uid is not None else f"upd{upd.update_id}"
+        rec = _backlog_chains.setdefault(key, {"chain": [], "started": False, "done": asyncio.Event()})
+        rec["chain"].append(upd)
+    _backlog_task = asyncio.create_task(
+        _replay_backlog(list(_backlog_chains), started, len(updates), len(payments), dropped)
+    )
+
+async def stop_backlog_replay():
+    if _backlog_task is not None and not _backlog_task.done():
+        _backlog_task.cancel()
+        try:
+            await _backlog_task
+        except asyncio.CancelledError:
+            pass
+
 # ---------------- RUN & AUTO-RESTART ----------------
 async def run_bot():
     """
@@ -716,8 +1663,10 @@ async def run_bot():
     max_backoff = 30
     while True:
         try:
+            if BACKLOG_REPLAY:
+                await drain_backlog()
             logger.info("✅ MarketSafe bot starting polling...")
-            await dp.start_polling(bot)
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
             # если start_polling завершился корректно — выходим
             break
         except (KeyboardInterrupt, SystemExit):
@@ -736,14 +1685,29 @@ async def run_bot():
                 pass
 
 async def main():
+    analytics.start()
+    resume_broadcast()
     try:
         await run_bot()
     finally:
+        try:
+            await stop_broadcast()
+        except Exception:
+            pass
+        try:
+            await stop_backlog_replay()
+        except Exception:
+            pass
+        try:
+            await analytics.stop()
+        except Exception:
+            pass
         # graceful shutdown: закрываем сессии и storage если возможно
         try:
             await bot.session.close()
         except Exception:
             pass
+        CLAIM_RENDER_EXECUTOR.shutdown(wait=False)
         try:
             await dp.storage.close()
             await dp.storage.wait_closed()